@@ -3,6 +3,7 @@ using System.Collections.Generic;
 using System.IO;
 using System.Linq;
 using System.Net.Sockets;
+using System.Runtime.InteropServices;
 using System.Threading;
 using System.Threading.Tasks;
 using MessagePack;
@@ -47,9 +48,9 @@ public class BrainClient : IDisposable
             sensors.Add(new
             {
                 id,
-                kvp.Value.PlantRetina,
-                kvp.Value.NonParasiteCreatureRetina,
-                kvp.Value.ParasiteCreatureRetina,
+                PlantRetina = ToBytes(kvp.Value.PlantRetina),
+                NonParasiteCreatureRetina = ToBytes(kvp.Value.NonParasiteCreatureRetina),
+                ParasiteCreatureRetina = ToBytes(kvp.Value.ParasiteCreatureRetina),
                 kvp.Value.Energy
             });
         }
@@ -82,7 +83,7 @@ public class BrainClient : IDisposable
         var initBatchMessage = new
         {
             type = "init",
-            brains = brainWeights.Select(kvp => new { Id = kvp.Key, Weights = kvp.Value })
+            brains = brainWeights.Select(kvp => new { id = kvp.Key, weights = ToBytes(kvp.Value) })
         };
 
         await _requestLock.WaitAsync();
@@ -106,10 +107,10 @@ public class BrainClient : IDisposable
             type = "train",
             training = transitions.Select(t => new {
                 id = t.Id,
-                state = t.State,
-                action = t.Action,
+                state = ToBytes(t.State),
+                action = ToBytes(t.Action),
                 reward = t.Reward,
-                next_state = t.NextState,
+                next_state = ToBytes(t.NextState),
                 done = t.Done
             }).ToList()
         };
@@ -128,6 +129,9 @@ public class BrainClient : IDisposable
         }
     }
 
+    // Float vectors go over the wire as raw float32 bytes (msgpack bin) so the server can copy them without parsing
+    private static byte[] ToBytes(float[] values) => MemoryMarshal.AsBytes(values.AsSpan()).ToArray();
+
     private async Task WriteMessageAsync<T>(T message)
     {
         byte[] bytes = MessagePackSerializer.Serialize(message, MessagePack.Resolvers.ContractlessStandardResolver.Options);
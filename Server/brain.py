@@ -0,0 +1,450 @@
+import array
+import operator
+import os
+import random
+
+# Each worker process runs single-threaded; parallelism comes from sharding creatures
+# across processes. The BLAS pools read these at import time, so set them before numpy and torch.
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.func import functional_call, grad_and_value, vmap
+
+# -------------------------------
+# Hyperparameters
+# -------------------------------
+STATE_DIM = 25   # Change this to the appropriate sensor vector size
+ACTION_DIM = 3   # Number of continuous outputs (for example, jet forces)
+BATCH_SIZE = 64
+GAMMA = 0.99
+TAU = 0.005
+TARGET_UPDATE_INTERVAL = 5  # train steps between target-network soft updates
+TARGET_TAU = 1 - (1 - TAU) ** TARGET_UPDATE_INTERVAL  # same decay as TAU applied every step
+LR_ACTOR = 2e-3
+LR_CRITIC = 2e-3
+ADAM_BETAS = (0.9, 0.999)
+ADAM_EPS = 1e-8
+TRAIN_STEPS_PER_TRANSITION = 5
+REPLAY_BUFFER_CAPACITY = 2000
+
+torch.set_num_threads(1)
+torch.set_num_interop_threads(1)
+
+# Networks, optimizer state and replay buffers all live on DEVICE; only sensor rows,
+# genomes and transitions cross over from the host.
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# TF32 only applies to CUDA matmuls, so the CPU training path keeps full fp32.
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+# Evaluate-path precision: bfloat16 is fastest on CPU, float16 has the wider GPU support
+EVAL_DTYPE = torch.float16 if DEVICE.type == "cuda" else torch.bfloat16
+# The compiled training passes keep one graph per power-of-two slot count (see train_step);
+# the default limit of 8 would send populations past 128 creatures back to eager mode.
+torch._dynamo.config.cache_size_limit = 32
+
+# Actor parameter shapes in the order they appear in a flat genome weight list
+ACTOR_PARAM_SHAPES = [(128, STATE_DIM), (128,), (128, 128), (128,), (ACTION_DIM, 128), (ACTION_DIM,)]
+ACTOR_PARAM_SIZES = [torch.Size(shape).numel() for shape in ACTOR_PARAM_SHAPES]
+
+# -------------------------------
+# Replay Buffer Class
+# -------------------------------
+class ReplayBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.states = torch.empty((capacity, STATE_DIM), device=DEVICE)
+        self.actions = torch.empty((capacity, ACTION_DIM), device=DEVICE)
+        self.rewards = torch.empty((capacity, 1), device=DEVICE)
+        self.next_states = torch.empty((capacity, STATE_DIM), device=DEVICE)
+        self.dones = torch.empty((capacity, 1), device=DEVICE)
+        self.pos = 0
+        self.size = 0
+    def push(self, state, action, reward, next_state, done):
+        # Takes one row of each field, already tensors on DEVICE
+        self.states[self.pos] = state
+        self.actions[self.pos] = action
+        self.rewards[self.pos] = reward
+        self.next_states[self.pos] = next_state
+        self.dones[self.pos] = done
+        self.pos = (self.pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+    def sample(self, batch_size, rounds=1):
+        # One minibatch per round, stacked on a leading axis. Indices are distinct within a
+        # minibatch like random.sample over the old deque, but O(batch_size) via range().
+        count = min(batch_size, self.size)
+        idx = torch.tensor([random.sample(range(self.size), count) for _ in range(rounds)], device=DEVICE)
+        return self.states[idx], self.actions[idx], self.rewards[idx], self.next_states[idx], self.dones[idx]
+    def __len__(self):
+        return self.size
+
+# -------------------------------
+# Actor Network (maps state to continuous actions)
+# -------------------------------
+class Actor(nn.Module):
+    def __init__(self, input_dim=STATE_DIM, output_dim=ACTION_DIM):
+        super(Actor, self).__init__()
+        self.fc1 = nn.Linear(input_dim, 128)
+        self.fc2 = nn.Linear(128, 128)
+        self.out = nn.Linear(128, output_dim)
+    def forward(self, x):
+        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc2(x))
+        # Use sigmoid to constrain outputs between 0 and 1
+        return torch.sigmoid(self.out(x))
+
+# -------------------------------
+# Critic Network (estimates Q–value given state and action)
+# -------------------------------
+class Critic(nn.Module):
+    def __init__(self, state_dim=STATE_DIM, action_dim=ACTION_DIM):
+        super(Critic, self).__init__()
+        self.fc1 = nn.Linear(state_dim + action_dim, 128)
+        self.fc2 = nn.Linear(128, 128)
+        self.out = nn.Linear(128, 1)
+    def forward(self, state, action):
+        x = torch.cat([state, action], dim=-1)
+        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc2(x))
+        return self.out(x)
+
+# -------------------------------
+# Actor forward over stacked per-creature weights
+# -------------------------------
+def stacked_actor_forward(idx, states, w1, b1, w2, b2, w3, b3):
+    x = torch.baddbmm(b1[idx].unsqueeze(2), w1[idx], states.unsqueeze(2)).relu_()
+    x = torch.baddbmm(b2[idx].unsqueeze(2), w2[idx], x).relu_()
+    return torch.baddbmm(b3[idx].unsqueeze(2), w3[idx], x).squeeze(2).sigmoid_()
+
+# -------------------------------
+# Helper: Split a flat weight tensor into actor parameter views
+# -------------------------------
+def actor_params_from_flat(flat_tensor):
+    # torch.split/view share the flat tensor's storage, so no per-layer copies are made.
+    return [chunk.view(shape) for chunk, shape in zip(torch.split(flat_tensor, ACTOR_PARAM_SIZES), ACTOR_PARAM_SHAPES)]
+
+# -------------------------------
+# Population: every creature's networks stacked along a leading slot axis
+# -------------------------------
+class Population:
+    def __init__(self, capacity=16):
+        self.slots = {}
+        # Templates for functional_call; their own parameters are never used.
+        self.actor_base = Actor().to(DEVICE)
+        self.critic_base = Critic().to(DEVICE)
+        self.actor = self._bank(self.actor_base, capacity)
+        self.critic = self._bank(self.critic_base, capacity)
+        self.actor_target = self._bank(self.actor_base, capacity)
+        self.critic_target = self._bank(self.critic_base, capacity)
+        # Adam moments and step counts per slot
+        self.actor_m = self._bank(self.actor_base, capacity)
+        self.actor_v = self._bank(self.actor_base, capacity)
+        self.critic_m = self._bank(self.critic_base, capacity)
+        self.critic_v = self._bank(self.critic_base, capacity)
+        # int64 so the counts stay exact; float32 stops incrementing at 2**24
+        self.steps = torch.zeros(capacity, dtype=torch.long, device=DEVICE)
+        self.replay_buffers = []
+        # Inference-only EVAL_DTYPE shadow of the actors, kept in sync after every weight change
+        self.actor_eval = {name: tensor.to(EVAL_DTYPE) for name, tensor in self.actor.items()}
+        # Compiled per-slot training passes (see train_step for how slot counts are bucketed)
+        self.target_values = torch.compile(self._target_values, dynamic=True)
+        self.critic_grad = torch.compile(self._critic_grad, dynamic=True)
+        self.actor_grad = torch.compile(self._actor_grad, dynamic=True)
+    @staticmethod
+    def _bank(module, capacity):
+        return {name: torch.zeros((capacity,) + p.shape, device=DEVICE) for name, p in module.named_parameters()}
+    def _grow(self):
+        for bank in (self.actor, self.critic, self.actor_target, self.critic_target,
+                     self.actor_m, self.actor_v, self.critic_m, self.critic_v):
+            for name, tensor in bank.items():
+                bank[name] = torch.cat([tensor, torch.zeros_like(tensor)])
+        for name, tensor in self.actor_eval.items():
+            self.actor_eval[name] = torch.cat([tensor, torch.zeros_like(tensor)])
+        self.steps = torch.cat([self.steps, torch.zeros_like(self.steps)])
+    def _sync_eval(self, idx):
+        for name, tensor in self.actor.items():
+            self.actor_eval[name][idx] = tensor[idx].to(EVAL_DTYPE)
+    def _reset_slot(self, slot):
+        # Fresh networks with default initialization, targets matching, and empty optimizer state
+        with torch.no_grad():
+            for bank, target, m, v, module in ((self.actor, self.actor_target, self.actor_m, self.actor_v, Actor()),
+                                               (self.critic, self.critic_target, self.critic_m, self.critic_v, Critic())):
+                for name, param in module.named_parameters():
+                    bank[name][slot] = param
+                    target[name][slot] = param
+                    m[name][slot] = 0
+                    v[name][slot] = 0
+        self._sync_eval(slot)
+        self.steps[slot] = 0
+        self.replay_buffers[slot] = ReplayBuffer(REPLAY_BUFFER_CAPACITY)
+    def slot(self, creature_id):
+        # Only ever called from the server's event loop, so no locking is needed.
+        slot = self.slots.get(creature_id)
+        if slot is None:
+            slot = len(self.slots)
+            if slot == self.steps.shape[0]:
+                self._grow()
+            self.replay_buffers.append(None)
+            self._reset_slot(slot)
+            self.slots[creature_id] = slot
+        return slot
+    def init_creature(self, creature_id, flat_weights):
+        values = actor_params_from_flat(flat_weights)
+        known = creature_id in self.slots
+        slot = self.slot(creature_id)
+        if known:
+            self._reset_slot(slot)
+        for tensor, value in zip(self.actor.values(), values):
+            tensor[slot] = value
+        self._sync_eval(slot)
+    def evaluate_batch(self, creature_ids, states):
+        # states is an (N, STATE_DIM) tensor; returns (N, ACTION_DIM) actions.
+        # Unseen creatures get their slot here. That has to happen outside inference mode,
+        # or their fresh networks and replay buffer would be inference tensors that training can't update.
+        idx = torch.tensor([self.slot(creature_id) for creature_id in creature_ids], device=DEVICE)
+        with torch.inference_mode():
+            actions = stacked_actor_forward(idx, states.to(DEVICE, EVAL_DTYPE), *self.actor_eval.values())
+        return actions.float()
+    def push_batch(self, slots, states, actions, rewards, next_states, dones):
+        # Row i of each packed tensor is a transition for slots[i].
+        for row, slot in enumerate(slots):
+            self.replay_buffers[slot].push(states[row], actions[row], rewards[row], next_states[row], dones[row])
+    def train(self, step_counts):
+        # step_counts maps slot -> number of train steps; slots step together in rounds.
+        # Buffers don't change while training, so every round's minibatches are sampled up front.
+        batches = {slot: self.replay_buffers[slot].sample(BATCH_SIZE, count)
+                   for slot, count in step_counts.items() if len(self.replay_buffers[slot]) >= BATCH_SIZE}
+        for step in range(max(step_counts.values(), default=0)):
+            slots = [slot for slot in batches if step_counts[slot] > step]
+            if slots:
+                self.train_step(slots, [tuple(field[step] for field in batches[slot]) for slot in slots])
+        # Nothing evaluates between rounds, so the shadow actors are refreshed once at the end.
+        if batches:
+            self._sync_eval(torch.tensor(list(batches), device=DEVICE))
+    def _actor_forward(self, actor, state):
+        return functional_call(self.actor_base, actor, (state,))
+    def _critic_forward(self, critic, state, action):
+        return functional_call(self.critic_base, critic, (state, action))
+    def _target_value(self, actor_target, critic_target, reward, next_state, done):
+        next_action = self._actor_forward(actor_target, next_state)
+        return reward + GAMMA * (1 - done) * self._critic_forward(critic_target, next_state, next_action)
+    def _critic_loss(self, critic, state, action, y):
+        return F.mse_loss(self._critic_forward(critic, state, action), y)
+    def _actor_loss(self, actor, critic, state):
+        return -self._critic_forward(critic, state, self._actor_forward(actor, state)).mean()
+    # Vmapped passes get their own methods so each compiled function has its own cache.
+    def _target_values(self, actor_target, critic_target, reward, next_state, done):
+        return vmap(self._target_value)(actor_target, critic_target, reward, next_state, done)
+    def _critic_grad(self, critic, state, action, y):
+        return vmap(grad_and_value(self._critic_loss))(critic, state, action, y)
+    def _actor_grad(self, actor, critic, state):
+        return vmap(grad_and_value(self._actor_loss))(actor, critic, state)
+    def train_step(self, slots, batches):
+        # batches holds one (state, action, reward, next_state, done) minibatch per slot.
+        count = len(slots)
+        idx = torch.tensor(slots, device=DEVICE)
+        # vmap specializes compiled code on the slot count, so pad it to a power of two by
+        # repeating the first slot; padded rows are dropped before any state is written back.
+        padded_idx = torch.cat([idx, idx[:1].repeat((1 << (count - 1).bit_length()) - count)])
+        batches = batches + batches[:1] * (len(padded_idx) - count)
+        state_batch, action_batch, reward_batch, next_state_batch, done_batch = (
+            torch.stack(field) for field in zip(*batches))
+        actor = {name: tensor[padded_idx] for name, tensor in self.actor.items()}
+        critic = {name: tensor[padded_idx] for name, tensor in self.critic.items()}
+        actor_target = {name: tensor[padded_idx] for name, tensor in self.actor_target.items()}
+        critic_target = {name: tensor[padded_idx] for name, tensor in self.critic_target.items()}
+        self.steps[idx] += 1
+        step = self.steps[idx]
+        # Critic update:
+        with torch.inference_mode():
+            y = self.target_values(actor_target, critic_target, reward_batch, next_state_batch, done_batch)
+        # mse_loss saves its target for backward, which inference tensors don't allow.
+        y = y.clone()
+        critic_grads, _ = self.critic_grad(critic, state_batch, action_batch, y)
+        self._adam_step(critic, critic_grads, self.critic_m, self.critic_v, idx, step, LR_CRITIC)
+        # Actor update (against the freshly updated critic):
+        actor_grads, _ = self.actor_grad(actor, critic, state_batch)
+        self._adam_step(actor, actor_grads, self.actor_m, self.actor_v, idx, step, LR_ACTOR)
+        for bank, values in ((self.actor, actor), (self.critic, critic)):
+            for name, value in values.items():
+                bank[name].index_copy_(0, idx, value[:count])
+        # Soft-update target networks, only on slots whose step is due:
+        due = (step % TARGET_UPDATE_INTERVAL == 0).nonzero().squeeze(1)
+        if len(due):
+            for online, target, bank in ((actor, actor_target, self.actor_target),
+                                         (critic, critic_target, self.critic_target)):
+                target_params = [value[due] for value in target.values()]
+                torch._foreach_mul_(target_params, 1 - TARGET_TAU)
+                torch._foreach_add_(target_params, [value[due] for value in online.values()], alpha=TARGET_TAU)
+                for name, value in zip(target, target_params):
+                    bank[name].index_copy_(0, idx[due], value)
+    def warmup(self, count=2):
+        # Compile the training passes up front so the first train command doesn't pay for it.
+        actor = {name: torch.zeros_like(tensor[:count]) for name, tensor in self.actor.items()}
+        critic = {name: torch.zeros_like(tensor[:count]) for name, tensor in self.critic.items()}
+        state = torch.zeros((count, BATCH_SIZE, STATE_DIM), device=DEVICE)
+        action = torch.zeros((count, BATCH_SIZE, ACTION_DIM), device=DEVICE)
+        reward = torch.zeros((count, BATCH_SIZE, 1), device=DEVICE)
+        done = torch.zeros((count, BATCH_SIZE, 1), device=DEVICE)
+        try:
+            with torch.inference_mode():
+                y = self.target_values(actor, critic, reward, state, done)
+            self.critic_grad(critic, state, action, y.clone())
+            self.actor_grad(actor, critic, state)
+        except Exception as e:
+            # Typically no working Inductor C++ toolchain on this host; the eager passes compute the same thing.
+            print(f"Compiling the training passes failed, training eagerly instead: {e!r}")
+            self.target_values = self._target_values
+            self.critic_grad = self._critic_grad
+            self.actor_grad = self._actor_grad
+    @staticmethod
+    def _adam_step(params, grads, m_bank, v_bank, idx, step, lr):
+        beta1, beta2 = ADAM_BETAS
+        count = len(idx)
+        names = list(params)
+        p = [params[name][:count] for name in names]
+        g = [grads[name][:count] for name in names]
+        m = [m_bank[name][idx] for name in names]
+        v = [v_bank[name][idx] for name in names]
+        torch._foreach_mul_(m, beta1)
+        torch._foreach_add_(m, g, alpha=1 - beta1)
+        torch._foreach_mul_(v, beta2)
+        torch._foreach_addcmul_(v, g, g, value=1 - beta2)
+        # Bias corrections differ per slot, so they are broadcast over each stacked tensor.
+        step = step.float()
+        bias_correction1 = 1 - beta1 ** step
+        bias_correction2_sqrt = (1 - beta2 ** step).sqrt()
+        denom = torch._foreach_sqrt(v)
+        torch._foreach_div_(denom, [bias_correction2_sqrt.view((-1,) + (1,) * (t.dim() - 1)) for t in denom])
+        torch._foreach_add_(denom, ADAM_EPS)
+        update = torch._foreach_div(m, denom)
+        torch._foreach_mul_(update, [(lr / bias_correction1).view((-1,) + (1,) * (t.dim() - 1)) for t in update])
+        torch._foreach_sub_(p, update)
+        for name, m_value, v_value in zip(names, m, v):
+            m_bank[name].index_copy_(0, idx, m_value)
+            v_bank[name].index_copy_(0, idx, v_value)
+
+population = Population()
+
+
+def extend_floats(buffer, values):
+    # Returns False, leaving buffer untouched, for packed bytes that aren't whole float32s.
+    if isinstance(values, bytes):
+        if len(values) % buffer.itemsize:
+            return False
+        # Packed little-endian float32 from the client, copied in one memcpy
+        buffer.frombytes(values)
+    else:
+        buffer.extend(values)
+    return True
+
+_sensor_fields = operator.itemgetter("PlantRetina", "NonParasiteCreatureRetina", "ParasiteCreatureRetina", "Energy")
+
+def evaluate_sensors(sensors_batch):
+    creature_ids = []
+    # Sensor rows are packed straight into one float32 buffer that torch wraps without copying
+    states = array.array('f')
+    for sensor in sensors_batch:
+        creature_id = sensor.get("id")
+        if creature_id is None:
+            continue
+        try:
+            plant_retina, non_parasite_retina, parasite_retina, energy = _sensor_fields(sensor)
+        except KeyError as e:
+            print(f"Missing sensor field: {e}")
+            continue
+        start = len(states)
+        packed = all([extend_floats(states, retina) for retina in (plant_retina, non_parasite_retina, parasite_retina)])
+        states.append(energy)
+        if not packed or len(states) - start != STATE_DIM:
+            print(f"Invalid sensor vector length for creature {creature_id}")
+            del states[start:]
+            continue
+        creature_ids.append(creature_id)
+    results = {}
+    if creature_ids:
+        state_tensor = torch.frombuffer(states, dtype=torch.float32).view(-1, STATE_DIM)
+        actions = population.evaluate_batch(creature_ids, state_tensor).tolist()
+        for creature_id, action in zip(creature_ids, actions):
+            results[int(creature_id)] = {
+                "Back": action[0],
+                "FrontRight": action[1],
+                "FrontLeft": action[2]
+            }
+    return results
+
+def process_command(request):
+    command_type = request.get("type")
+    if command_type == "evaluate":
+        sensors_batch = request.get("sensors")
+        if sensors_batch is None:
+            return {"Error": "Missing 'sensors' field in evaluate command."}
+        return {"Status": "ok", "Results": evaluate_sensors(sensors_batch)}
+    elif command_type == "train":
+        training_batch = request.get("training", [])
+        # Transitions are packed row by row into float32 buffers, like sensors in
+        # evaluate_sensors, and moved to the device in one copy per field.
+        slots = []
+        states, actions, next_states = array.array('f'), array.array('f'), array.array('f')
+        rewards, dones = array.array('f'), array.array('f')
+        for item in training_batch:
+            creature_id = item.get("id")
+            state = item.get("state")
+            action = item.get("action")
+            reward = item.get("reward")
+            next_state = item.get("next_state")
+            done = item.get("done", False)
+            if state is None or action is None or reward is None or next_state is None:
+                continue
+            row = len(slots)
+            packed = all([extend_floats(states, state), extend_floats(actions, action),
+                          extend_floats(next_states, next_state)])
+            if not packed or (len(states), len(actions), len(next_states)) != (
+                    (row + 1) * STATE_DIM, (row + 1) * ACTION_DIM, (row + 1) * STATE_DIM):
+                print(f"Invalid transition length for creature {creature_id}")
+                del states[row * STATE_DIM:], actions[row * ACTION_DIM:], next_states[row * STATE_DIM:]
+                continue
+            rewards.append(reward)
+            dones.append(float(done))
+            slots.append(population.slot(creature_id))
+        step_counts = {}
+        if slots:
+            population.push_batch(slots, *(torch.frombuffer(buffer, dtype=torch.float32).to(DEVICE).view(len(slots), -1)
+                                           for buffer in (states, actions, rewards, next_states, dones)))
+            for slot in slots:
+                step_counts[slot] = step_counts.get(slot, 0) + TRAIN_STEPS_PER_TRANSITION
+        population.train(step_counts)
+        return {"Status": "ok"}
+    elif command_type == "init":
+        brains_list = request.get("brains")
+        if brains_list is None:
+            return {"Error": "Missing 'brains' field for init_batch command."}
+        results = {}
+        creature_ids = []
+        weight_lists = []
+        for brain_spec in brains_list:
+            creature_id = brain_spec.get("id")
+            flat_weights = brain_spec.get("weights")
+            if creature_id is None or flat_weights is None:
+                # Record an error for this entry. Using "unknown" if id is missing.
+                results[creature_id if creature_id is not None else "unknown"] = "Missing 'id' or 'weights'"
+            else:
+                creature_ids.append(creature_id)
+                weight_lists.append(flat_weights)
+        if creature_ids:
+            try:
+                # Convert every genome in one vectorized pass; each row is then a zero-copy view.
+                # Packed float32 genomes are viewed with frombuffer instead of being parsed.
+                weights = torch.from_numpy(np.asarray(
+                    [np.frombuffer(w, dtype=np.float32) if isinstance(w, bytes) else w for w in weight_lists],
+                    dtype=np.float32))
+                for creature_id, flat_weights in zip(creature_ids, weights):
+                    population.init_creature(int(creature_id), flat_weights)
+            except Exception as e:
+                 return {"Status": "error", "Error": str(e)}
+        return {"Status": "ok"}
+    else:
+        return {"Status": "error", "Error": f"Unknown command type: {command_type}"}